@@ -1,32 +1,66 @@
-from pyrogram import Client, filters
-from pyrogram.handlers import MessageHandler
-from pyrogram.types import Message
+from __future__ import annotations
+
+import time
+
+# Отсчёт холодного старта (импорты, конфиг, подключение аккаунтов)
+startup_started = time.perf_counter()
+
 from decouple import config
 
-from fastapi import FastAPI, WebSocket, WebSocketDisconnect, HTTPException
+from fastapi import FastAPI, WebSocket, WebSocketDisconnect, HTTPException, Request
 from fastapi.staticfiles import StaticFiles
-from fastapi.responses import FileResponse
+from fastapi.responses import FileResponse, Response, StreamingResponse
 from fastapi.middleware.cors import CORSMiddleware
+from starlette.background import BackgroundTask
+from starlette.datastructures import Headers
+from starlette.staticfiles import NotModifiedResponse
 import uvicorn
 
 import asyncio
+from contextlib import asynccontextmanager
+import gzip
+import hashlib
+import json
+import logging
+import mimetypes
+import os
+import uuid
 from pathlib import Path
 import re
+import threading
+
+try:
+    # Optional fast JSON encoder for polled endpoints
+    import orjson  # type: ignore
+except Exception:
+    orjson = None  # type: ignore
 
 try:
-    # Optional raw imports for resolving phone -> user
-    from pyrogram.raw.functions.contacts import ImportContacts  # type: ignore
-    from pyrogram.raw.types import InputPhoneContact  # type: ignore
+    # Optional brotli for on-the-fly compression of the SPA bundle
+    import brotli  # type: ignore
 except Exception:
-    ImportContacts = None  # type: ignore
-    InputPhoneContact = None  # type: ignore
-from typing import Dict, Set, List, Any
+    brotli = None  # type: ignore
+
+from typing import Dict, Set, List, Any, Optional, Tuple, Callable, Awaitable, TYPE_CHECKING
+
+if TYPE_CHECKING:
+    # Pyrogram импортируется лениво (см. load_pyrogram), здесь только для аннотаций
+    from pyrogram import Client
+    from pyrogram.types import Message
+
+logger = logging.getLogger("uvicorn.error")
+
+startup_timings_ms: Dict[str, float] = {}
+startup_errors: Dict[str, str] = {}
+warm_up_done = False
+startup_target_ms = float(config("STARTUP_TARGET_MS", default=3000))
 
 
-# Данные приложения/аккаунта
-api_id = int(config("API_ID"))
-api_hash = config("API_HASH")
-login = config("LOGIN")  # имя файла сессии
+def record_timing(name: str, started: float) -> None:
+    startup_timings_ms[name] = round((time.perf_counter() - started) * 1000, 1)
+
+
+record_timing("imports", startup_started)
 
 # Директория для хранения .session (persist между перезапусками)
 session_dir = config("SESSION_DIR", default=str((Path(__file__).parent / "sessions").resolve()))
@@ -35,29 +69,133 @@ try:
 except Exception:
     pass
 
-
-# Инициализация Pyrogram-клиента (без автологина)
-# Опциональный прокси (на случай блокировок Telegram в сети)
-proxy = None
+# Дисковый LRU-кэш медиа (файлы и превью из сообщений)
+media_cache_dir = Path(session_dir) / "media_cache"
+media_cache_max_bytes = int(config("MEDIA_CACHE_MAX_MB", default=512)) * 1024 * 1024
 try:
-    proxy_host = config("PROXY_HOST", default=None)
-    proxy_port = config("PROXY_PORT", default=None)
-    if proxy_host and proxy_port:
-        proxy = {
-            "scheme": config("PROXY_SCHEME", default="socks5"),
-            "hostname": proxy_host,
-            "port": int(proxy_port),
-        }
-        proxy_user = config("PROXY_USERNAME", default=None)
-        proxy_pass = config("PROXY_PASSWORD", default=None)
-        if proxy_user:
-            proxy["username"] = proxy_user
-        if proxy_pass:
-            proxy["password"] = proxy_pass
+    media_cache_dir.mkdir(parents=True, exist_ok=True)
 except Exception:
+    pass
+
+
+# Данные приложения/аккаунта читаются при первом создании клиента
+tg_settings: Optional[Dict[str, Any]] = None
+
+
+def get_tg_settings() -> Dict[str, Any]:
+    global tg_settings
+    if tg_settings is not None:
+        return tg_settings
+    started = time.perf_counter()
+    # Опциональный прокси (на случай блокировок Telegram в сети)
     proxy = None
+    try:
+        proxy_host = config("PROXY_HOST", default=None)
+        proxy_port = config("PROXY_PORT", default=None)
+        if proxy_host and proxy_port:
+            proxy = {
+                "scheme": config("PROXY_SCHEME", default="socks5"),
+                "hostname": proxy_host,
+                "port": int(proxy_port),
+            }
+            proxy_user = config("PROXY_USERNAME", default=None)
+            proxy_pass = config("PROXY_PASSWORD", default=None)
+            if proxy_user:
+                proxy["username"] = proxy_user
+            if proxy_pass:
+                proxy["password"] = proxy_pass
+    except Exception:
+        proxy = None
+    tg_settings = {
+        "api_id": int(config("API_ID")),
+        "api_hash": config("API_HASH"),
+        "login": config("LOGIN"),  # имя файла сессии
+        "proxy": proxy,
+    }
+    record_timing("config", started)
+    return tg_settings
+
+
+pyrogram_loaded = False
+pyrogram_import_lock = threading.Lock()
+# Общий импорт в потоке: обработчики в event loop ждут его через ensure_pyrogram, не блокируя loop
+pyrogram_import_task: Optional["asyncio.Future[None]"] = None
+
+
+def load_pyrogram(loop: Optional[asyncio.AbstractEventLoop] = None) -> None:
+    # Тяжёлый импорт pyrogram откладывается до первого клиента (или фонового прогрева).
+    # В event loop сюда приходят только после await ensure_pyrogram() (быстрый путь без блокировки);
+    # ждать на блокировке может лишь синхронный вызов вне loop.
+    global pyrogram_loaded
+    if pyrogram_loaded:
+        return
+    with pyrogram_import_lock:
+        if pyrogram_loaded:
+            return
+        started = time.perf_counter()
+        if loop is not None:
+            # pyrogram.sync при импорте запоминает текущий event loop — в потоке подставляем основной
+            asyncio.set_event_loop(loop)
+        try:
+            import pyrogram  # noqa: F401
+            import pyrogram.errors  # noqa: F401
+            import pyrogram.handlers  # noqa: F401
+        finally:
+            if loop is not None:
+                asyncio.set_event_loop(None)
+        pyrogram_loaded = True
+        record_timing("pyrogram_import", started)
+
+
+async def ensure_pyrogram() -> None:
+    global pyrogram_import_task
+    if pyrogram_loaded:
+        return
+    task = pyrogram_import_task
+    if task is None:
+        task = asyncio.ensure_future(asyncio.to_thread(load_pyrogram, asyncio.get_running_loop()))
+        pyrogram_import_task = task
+
+        def _done(t: "asyncio.Future[None]") -> None:
+            global pyrogram_import_task
+            if t.cancelled() or t.exception() is not None:
+                pyrogram_import_task = None  # следующий вызов попробует импортировать заново
+
+        task.add_done_callback(_done)
+    # shield: отмена одного запроса не должна обрывать общий импорт
+    await asyncio.shield(task)
+
+
+def create_client(name: str) -> "Client":
+    # Инициализация Pyrogram-клиента (без автологина)
+    load_pyrogram()
+    from pyrogram import Client
+
+    settings = get_tg_settings()
+    return Client(
+        name=name,
+        api_id=settings["api_id"],
+        api_hash=settings["api_hash"],
+        proxy=settings["proxy"],
+        workdir=session_dir,
+        in_memory=True,
+    )
+
+
+bot: Optional["Client"] = None
+
 
-bot = Client(name=login, api_id=api_id, api_hash=api_hash, proxy=proxy, workdir=session_dir, in_memory=True)
+def get_bot() -> "Client":
+    global bot
+    if bot is None:
+        load_pyrogram()
+        from pyrogram import filters
+        from pyrogram.handlers import MessageHandler
+
+        c = create_client(get_tg_settings()["login"])
+        c.add_handler(MessageHandler(incoming_handler, filters.incoming & ~filters.service))
+        bot = c
+    return bot
 
 
 # Глобальные состояния
@@ -79,11 +217,21 @@ queued_chat_order_by_account: Dict[str, List[int]] = {}
 queued_chat_set_by_account: Dict[str, Set[int]] = {}
 queue_lock = asyncio.Lock()
 
+# Версии состояния очереди по аккаунтам ("" — основной bot), для ETag у /queue.
+# Счётчики начинаются заново в каждом процессе, поэтому в ETag добавляется id запуска.
+queue_version_by_account: Dict[str, int] = {}
+queue_boot_id = uuid.uuid4().hex[:8]
+
+
+def bump_queue_version(account: str = "") -> None:
+    queue_version_by_account[account] = queue_version_by_account.get(account, 0) + 1
+
 
 def ensure_in_queue(chat_id: int) -> None:
     if chat_id not in queued_chat_set:
         queued_chat_set.add(chat_id)
         queued_chat_order.append(chat_id)
+        bump_queue_version()
 
 
 def remove_from_queue(chat_id: int) -> None:
@@ -93,15 +241,19 @@ def remove_from_queue(chat_id: int) -> None:
             queued_chat_order.remove(chat_id)
         except ValueError:
             pass
+        bump_queue_version()
 
 
 def move_to_queue_end(chat_id: int) -> None:
     if chat_id in queued_chat_set:
+        if queued_chat_order and queued_chat_order[-1] == chat_id:
+            return
         try:
             queued_chat_order.remove(chat_id)
         except ValueError:
             pass
         queued_chat_order.append(chat_id)
+        bump_queue_version()
     else:
         ensure_in_queue(chat_id)
 
@@ -114,6 +266,7 @@ def ensure_in_queue_for_account(account: str, chat_id: int) -> None:
     if chat_id not in queued_chat_set_by_account[account]:
         queued_chat_set_by_account[account].add(chat_id)
         queued_chat_order_by_account[account].append(chat_id)
+        bump_queue_version(account)
 
 
 def remove_from_queue_for_account(account: str, chat_id: int) -> None:
@@ -125,6 +278,7 @@ def remove_from_queue_for_account(account: str, chat_id: int) -> None:
             queued_chat_order_by_account[account].remove(chat_id)
         except ValueError:
             pass
+        bump_queue_version(account)
 
 
 def move_to_queue_end_for_account(account: str, chat_id: int) -> None:
@@ -133,15 +287,59 @@ def move_to_queue_end_for_account(account: str, chat_id: int) -> None:
     if account not in queued_chat_order_by_account:
         queued_chat_order_by_account[account] = []
     if chat_id in queued_chat_set_by_account[account]:
+        order = queued_chat_order_by_account[account]
+        if order and order[-1] == chat_id:
+            return
         try:
-            queued_chat_order_by_account[account].remove(chat_id)
+            order.remove(chat_id)
         except ValueError:
             pass
-        queued_chat_order_by_account[account].append(chat_id)
+        order.append(chat_id)
+        bump_queue_version(account)
     else:
         ensure_in_queue_for_account(account, chat_id)
 
 
+# ==== УСЛОВНЫЕ ОТВЕТЫ (ETag / 304) ====
+
+def dumps_json(payload: Any) -> bytes:
+    if orjson is not None:
+        return orjson.dumps(payload)
+    return json.dumps(payload, ensure_ascii=False, separators=(",", ":")).encode("utf-8")
+
+
+def etag_matches(request: Request, etag: str) -> bool:
+    header = request.headers.get("if-none-match")
+    if not header:
+        return False
+    if header.strip() == "*":
+        return True
+    candidates = [c.strip() for c in header.split(",")]
+    # слабое сравнение: W/"x" совпадает с "x"
+    bare = etag[2:] if etag.startswith("W/") else etag
+    return any((c[2:] if c.startswith("W/") else c) == bare for c in candidates)
+
+
+def not_modified(etag: str) -> Response:
+    return Response(status_code=304, headers={"ETag": etag, "Cache-Control": "no-cache"})
+
+
+def conditional_json(request: Request, payload: Any, etag: Optional[str] = None) -> Response:
+    # Если etag задан, 304 отдаётся без сериализации; иначе он считается по телу
+    if etag is not None and etag_matches(request, etag):
+        return not_modified(etag)
+    body = dumps_json(payload)
+    if etag is None:
+        etag = '"' + hashlib.blake2b(body, digest_size=16).hexdigest() + '"'
+        if etag_matches(request, etag):
+            return not_modified(etag)
+    return Response(
+        content=body,
+        media_type="application/json",
+        headers={"ETag": etag, "Cache-Control": "no-cache"},
+    )
+
+
 async def broadcast(event: Dict[str, Any]) -> None:
     stale: List[WebSocket] = []
     for ws in connected_clients:
@@ -156,7 +354,6 @@ async def broadcast(event: Dict[str, Any]) -> None:
             pass
 
 
-@bot.on_message(filters.incoming & ~filters.service)
 async def incoming_handler(client: Client, message: Message):
     chat_id = message.chat.id
     # filter: only private chats
@@ -168,6 +365,7 @@ async def incoming_handler(client: Client, message: Message):
     if type_name != "private":
         return
 
+    cancel_pending_read("", chat_id)
     ensure_in_queue(chat_id)
 
     preview_text = (message.text or message.caption or "").strip()
@@ -180,11 +378,12 @@ async def incoming_handler(client: Client, message: Message):
     except Exception:
         author = None
 
-    # Не шлём пустые текстовые сообщения в realtime, но сохраняем чат в очереди выше
-    if preview_text:
+    # Не шлём пустые текстовые сообщения как "message", медиа без подписи идёт отдельным типом
+    media = describe_media(message)
+    if preview_text or media:
         await broadcast(
             {
-                "type": "message",
+                "type": "message" if preview_text else "media_message",
                 "account": "",
                 "chat_id": chat_id,
                 "chat_title": message.chat.title if getattr(message.chat, "title", None) else author or "",
@@ -194,6 +393,7 @@ async def incoming_handler(client: Client, message: Message):
                     "date": int(message.date.timestamp()) if message.date else None,
                     "from_user_id": message.from_user.id if message.from_user else None,
                     "outgoing": message.outgoing,
+                    "media": media,
                 },
             }
         )
@@ -223,8 +423,10 @@ async def root():
             "/dialogs",
             "/messages",
             "/send_message",
+            "/media",
             "/queue",
             "/queue/action",
+            "/queue/actions",
             "/ws",
         ],
     }
@@ -235,20 +437,37 @@ async def healthz():
     return {"ok": True}
 
 
+@app.get("/readyz")
+async def readyz():
+    # Готовность отдельно от liveness в /healthz: прогрев завершён и основной клиент подключён.
+    # Если не подключились только аккаунты из PRECONNECT_ACCOUNTS — готовы, но в состоянии "degraded".
+    connected = bot is not None and bot.is_connected
+    ready = warm_up_done and connected
+    if not warm_up_done:
+        state = "starting"
+    elif not connected:
+        state = "failed"
+    else:
+        state = "degraded" if startup_errors else "ready"
+    payload = {
+        "ready": ready,
+        "state": state,
+        "startup": {"timings_ms": startup_timings_ms, "errors": startup_errors, "target_ms": startup_target_ms},
+    }
+    return Response(content=dumps_json(payload), status_code=200 if ready else 503, media_type="application/json")
+
+
 async def ensure_connected() -> None:
-    try:
-        if not bot.is_connected:
-            await bot.connect()
-    except Exception:
-        await bot.connect()
+    await ensure_pyrogram()
+    await ensure_client_connected(get_bot())
 
 
 async def ensure_started() -> None:
     # Подключаемся без инициирования интерактивного старта.
     # Если сессия уже сохранена, get_me сработает; если нет — просто вернёмся без авторизации.
     try:
-        if not bot.is_connected:
-            await bot.connect()
+        await ensure_pyrogram()
+        await ensure_client_connected(get_bot())
     except Exception:
         pass
 
@@ -268,6 +487,7 @@ def attach_incoming_handler(client: Client, account: str) -> None:
         if type_name != "private":
             return
 
+        cancel_pending_read(account, message.chat.id)
         ensure_in_queue_for_account(account, message.chat.id)
 
         preview_text = (message.text or message.caption or "").strip()
@@ -280,10 +500,11 @@ def attach_incoming_handler(client: Client, account: str) -> None:
         except Exception:
             author = None
 
-        if preview_text:
+        media = describe_media(message)
+        if preview_text or media:
             await broadcast(
                 {
-                    "type": "message",
+                    "type": "message" if preview_text else "media_message",
                     "account": account,
                     "chat_id": message.chat.id,
                     "chat_title": message.chat.title if getattr(message.chat, "title", None) else author or "",
@@ -293,10 +514,14 @@ def attach_incoming_handler(client: Client, account: str) -> None:
                         "date": int(message.date.timestamp()) if message.date else None,
                         "from_user_id": message.from_user.id if message.from_user else None,
                         "outgoing": message.outgoing,
+                        "media": media,
                     },
                 }
             )
 
+    from pyrogram import filters
+    from pyrogram.handlers import MessageHandler
+
     client.add_handler(MessageHandler(_handler, filters.incoming & ~filters.service))
 
 
@@ -304,31 +529,259 @@ def get_or_create_client(account: str) -> Client:
     account_key = account.strip()
     if account_key in clients:
         return clients[account_key]
-    c = Client(
-        name=account_key,
-        api_id=api_id,
-        api_hash=api_hash,
-        proxy=proxy,
-        workdir=session_dir,
-        in_memory=True,
-    )
+    c = create_client(account_key)
     attach_incoming_handler(c, account_key)
     clients[account_key] = c
     return c
 
 
+async def get_connected_client(account: str) -> Client:
+    await ensure_pyrogram()
+    client = get_or_create_client(account)
+    await ensure_client_connected(client)
+    return client
+
+
+# Текущие подключения: фоновый прогрев и первый запрос ждут одно и то же connect()
+connect_tasks: Dict[int, "asyncio.Future[Any]"] = {}
+
+
 async def ensure_client_connected(client: Client) -> None:
+    if client.is_connected:
+        return
+    await ensure_pyrogram()
+    key = id(client)
+    task = connect_tasks.get(key)
+    if task is None:
+        task = asyncio.ensure_future(client.connect())
+        connect_tasks[key] = task
+        task.add_done_callback(lambda _t: connect_tasks.pop(key, None))
     try:
+        await asyncio.shield(task)
+    except Exception:
         if not client.is_connected:
             await client.connect()
-    except Exception:
-        await client.connect()
+
+
+# ==== SINGLE-FLIGHT ВЫЗОВЫ TELEGRAM ====
+# Одновременные одинаковые вызовы (аккаунт, метод, аргументы) делят один запрос к Telegram,
+# а число запросов к Telegram в полёте на аккаунт ограничено — сверх лимита отвечаем 503.
+max_inflight_per_account = int(config("MAX_INFLIGHT_PER_ACCOUNT", default=8))
+inflight_calls: Dict[Tuple[str, str, tuple], "asyncio.Future[Any]"] = {}
+inflight_count_by_account: Dict[str, int] = {}
+# Скачивания медиа идут минутами, поэтому у них отдельный лимит и они не занимают слоты RPC
+max_media_transfers_per_account = int(config("MAX_MEDIA_TRANSFERS_PER_ACCOUNT", default=4))
+media_transfers_by_account: Dict[str, int] = {}
+
+
+class Admission:
+    # Слот в лимите запросов аккаунта (media=True — в лимите скачиваний медиа); release() идемпотентен
+    def __init__(self, account: str, media: bool = False) -> None:
+        self.account = account.strip()
+        self.counts = media_transfers_by_account if media else inflight_count_by_account
+        limit = max_media_transfers_per_account if media else max_inflight_per_account
+        if self.counts.get(self.account, 0) >= limit:
+            raise HTTPException(
+                status_code=503,
+                detail="Too many concurrent media downloads for this account"
+                if media
+                else "Too many concurrent Telegram requests for this account",
+                headers={"Retry-After": "1"},
+            )
+        self.counts[self.account] = self.counts.get(self.account, 0) + 1
+        self.released = False
+
+    def release(self) -> None:
+        if self.released:
+            return
+        self.released = True
+        count = self.counts.get(self.account, 1) - 1
+        if count > 0:
+            self.counts[self.account] = count
+        else:
+            self.counts.pop(self.account, None)
+
+
+@asynccontextmanager
+async def admit(account: str):
+    admission = Admission(account)
+    try:
+        yield
+    finally:
+        admission.release()
+
+
+async def iter_admitted(admission: Admission, chunks: Any):
+    # Держит слот, пока стримится ответ (освобождается и фоновой задачей ответа)
+    try:
+        async for chunk in chunks:
+            yield chunk
+    finally:
+        admission.release()
+
+
+async def coalesced(account: str, method: str, args: tuple, factory: Callable[[], Awaitable[Any]]) -> Any:
+    account = account.strip()
+    key = (account, method, args)
+    task = inflight_calls.get(key)
+    if task is None:
+        admission = Admission(account)
+        task = asyncio.ensure_future(factory())
+        inflight_calls[key] = task
+
+        def _done(t: "asyncio.Future[Any]") -> None:
+            inflight_calls.pop(key, None)
+            admission.release()
+            if not t.cancelled():
+                t.exception()  # помечаем ошибку как полученную, даже если все ждущие отменились
+
+        task.add_done_callback(_done)
+    # shield: отмена одного запроса не должна обрывать общий вызов
+    return await asyncio.shield(task)
+
+
+async def collect_dialogs(client: Client, limit: int = 0) -> List[Any]:
+    return [d async for d in client.get_dialogs(limit=limit)]
+
+
+# ==== ФОНОВАЯ ОТМЕТКА ПРОЧТЕНИЯ ====
+# "done" не ждёт read_chat_history: чат кладётся в pending_reads (повторы схлопываются),
+# а воркер отправляет запросы с паузой mark_read_interval и повторяет их при ошибках.
+mark_read_interval = float(config("MARK_READ_INTERVAL", default=0.3))
+mark_read_max_attempts = int(config("MARK_READ_MAX_ATTEMPTS", default=5))
+pending_reads: Dict[str, Dict[Any, int]] = {}  # аккаунт -> {chat_id: число неудачных попыток}
+mark_read_wakeup = asyncio.Event()
+mark_read_task: Optional["asyncio.Task[None]"] = None
+
+
+def schedule_mark_read(account: str, chat_id: Any) -> None:
+    pending_reads.setdefault(account, {}).setdefault(chat_id, 0)
+    mark_read_wakeup.set()
+
+
+def cancel_pending_read(account: str, chat_id: Any) -> None:
+    # Новое входящее сообщение: чат снова требует внимания, старое прочтение не отправляем
+    pending = pending_reads.get(account)
+    if pending:
+        pending.pop(chat_id, None)
+
+
+def is_read_pending(account: str, chat_id: Any) -> bool:
+    return chat_id in pending_reads.get(account, {})
+
+
+async def send_mark_read(account: str, chat_id: Any) -> None:
+    if account:
+        client = await get_connected_client(account)
+    else:
+        await ensure_started()
+        client = get_bot()
+    async with admit(account):
+        await client.read_chat_history(chat_id)
+
+
+async def flush_pending_reads() -> None:
+    if not pending_reads:
+        return
+    await ensure_pyrogram()
+    from pyrogram.errors import FloodWait
+
+    for account in list(pending_reads.keys()):
+        pending = pending_reads.get(account) or {}
+        for chat_id in list(pending.keys()):
+            if chat_id not in pending:
+                continue
+            try:
+                await send_mark_read(account, chat_id)
+                pending.pop(chat_id, None)
+            except FloodWait as e:
+                await asyncio.sleep(float(getattr(e, "value", 1) or 1))
+            except HTTPException:
+                pass  # лимит аккаунта занят — повторим позже, попытку не засчитываем
+            except Exception:
+                attempts = pending.get(chat_id)
+                if attempts is not None:
+                    if attempts + 1 >= mark_read_max_attempts:
+                        pending.pop(chat_id, None)
+                    else:
+                        pending[chat_id] = attempts + 1
+            await asyncio.sleep(mark_read_interval)
+        if not pending:
+            pending_reads.pop(account, None)
+
+
+async def mark_read_worker() -> None:
+    while True:
+        await mark_read_wakeup.wait()
+        mark_read_wakeup.clear()
+        try:
+            await flush_pending_reads()
+        except Exception:
+            pass
+        if pending_reads:
+            # остались неудачные попытки — повторяем с паузой
+            await asyncio.sleep(max(mark_read_interval, 1.0) * 5)
+            mark_read_wakeup.set()
+
+
+# ==== ХОЛОДНЫЙ СТАРТ ====
+# Клиенты подключаются в фоне после старта сервера: основной (LOGIN) и аккаунты из PRECONNECT_ACCOUNTS.
+preconnect_accounts = [a.strip() for a in config("PRECONNECT_ACCOUNTS", default="").split(",") if a.strip()]
+warm_up_task: Optional["asyncio.Task[None]"] = None
+
+
+async def connect_known_account(account: str) -> None:
+    started = time.perf_counter()
+    name = "connect:" + (account or "default")
+    try:
+        await ensure_pyrogram()
+        client = get_or_create_client(account) if account else get_bot()
+        await ensure_client_connected(client)
+        record_timing(name, started)
+    except Exception as e:
+        startup_errors[name] = str(e)
+
+
+async def warm_up() -> None:
+    global warm_up_done
+    started = time.perf_counter()
+    try:
+        # импорт в потоке: event loop свободен, и uvicorn открывает порт, не дожидаясь pyrogram
+        await ensure_pyrogram()
+        get_tg_settings()
+        await asyncio.gather(*(connect_known_account(a) for a in [""] + preconnect_accounts))
+    except Exception as e:
+        startup_errors["warm_up"] = str(e)
+    record_timing("warm_up", started)
+    record_timing("total", startup_started)
+    warm_up_done = True
+    logger.info("Startup timings (ms): %s", startup_timings_ms)
+    if startup_errors:
+        logger.error("Startup errors: %s", startup_errors)
+    if startup_timings_ms["total"] > startup_target_ms:
+        logger.warning("Cold start took %.0f ms, target is %.0f ms", startup_timings_ms["total"], startup_target_ms)
+
+
+@app.on_event("startup")
+async def on_startup():
+    global mark_read_task, warm_up_task
+    mark_read_task = asyncio.create_task(mark_read_worker())
+    warm_up_task = asyncio.create_task(warm_up())
 
 
 @app.on_event("shutdown")
 async def on_shutdown():
+    for task in (mark_read_task, warm_up_task):
+        if task is not None:
+            task.cancel()
+    # Досылаем накопленные прочтения до остановки клиентов
     try:
-        await bot.stop()
+        await asyncio.wait_for(flush_pending_reads(), timeout=5)
+    except Exception:
+        pass
+    try:
+        if bot is not None:
+            await bot.stop()
     except Exception:
         pass
     # Останавливаем мульти-клиентов
@@ -348,20 +801,20 @@ async def auth_send_code(payload: Dict[str, str]):
     if not phone:
         raise HTTPException(status_code=400, detail="phone is required")
 
-    client = get_or_create_client(phone)
-    await ensure_client_connected(client)
-    try:
-        sent = await client.send_code(phone)
-        # Сохраняем хеш кода для последующего sign_in
-        phone_code_hash = getattr(sent, "phone_code_hash", None) or getattr(sent, "phone_code", None)
-        if not phone_code_hash:
-            # Нестандартный случай, но вернем ok без хеша
-            pending_logins[phone] = ""
-            return {"ok": True}
-        pending_logins[phone] = phone_code_hash
-        return {"ok": True, "phone_code_hash": phone_code_hash}
-    except Exception as e:
-        raise HTTPException(status_code=400, detail=str(e))
+    client = await get_connected_client(phone)
+    async with admit(phone):
+        try:
+            sent = await client.send_code(phone)
+        except Exception as e:
+            raise HTTPException(status_code=400, detail=str(e))
+    # Сохраняем хеш кода для последующего sign_in
+    phone_code_hash = getattr(sent, "phone_code_hash", None) or getattr(sent, "phone_code", None)
+    if not phone_code_hash:
+        # Нестандартный случай, но вернем ok без хеша
+        pending_logins[phone] = ""
+        return {"ok": True}
+    pending_logins[phone] = phone_code_hash
+    return {"ok": True, "phone_code_hash": phone_code_hash}
 
 
 @app.api_route("/auth/sign_in", methods=["POST", "OPTIONS"])  # поддержка и без/с preflight
@@ -378,59 +831,62 @@ async def auth_sign_in(payload: Dict[str, str]):
     if not phone_code_hash:
         raise HTTPException(status_code=400, detail="send_code must be called first")
 
-    client = get_or_create_client(phone)
-    await ensure_client_connected(client)
-    try:
-        await client.sign_in(phone_number=phone, phone_code=code, phone_code_hash=phone_code_hash)
-    except Exception as e:
-        if "SESSION_PASSWORD_NEEDED" in str(e).upper() or "PASSWORD" in str(e).upper():
-            if not password:
-                raise HTTPException(status_code=401, detail="Two-factor password required")
-            await client.check_password(password=password)
-        else:
-            raise HTTPException(status_code=400, detail=str(e))
+    client = await get_connected_client(phone)
+    async with admit(phone):
+        try:
+            await client.sign_in(phone_number=phone, phone_code=code, phone_code_hash=phone_code_hash)
+        except Exception as e:
+            if "SESSION_PASSWORD_NEEDED" in str(e).upper() or "PASSWORD" in str(e).upper():
+                if not password:
+                    raise HTTPException(status_code=401, detail="Two-factor password required")
+                await client.check_password(password=password)
+            else:
+                raise HTTPException(status_code=400, detail=str(e))
 
-    try:
-        me = await client.get_me()
-    except Exception:
-        me = None
+        try:
+            me = await client.get_me()
+        except Exception:
+            me = None
 
     return {"ok": True, "me": {"id": me.id, "first_name": me.first_name, "username": me.username} if me else None}
 
 
 @app.get("/me")
-async def get_me(account: str = ""):
+async def get_me(request: Request, account: str = ""):
     try:
         if account:
-            client = get_or_create_client(account)
-            await ensure_client_connected(client)
-            me = await client.get_me()
+            client = await get_connected_client(account)
+            me = await coalesced(account, "get_me", (), client.get_me)
         else:
             await ensure_started()
-            me = await bot.get_me()
-        return {"authorized": True, "me": {"id": me.id, "first_name": me.first_name, "username": me.username}}
+            me = await coalesced("", "get_me", (), get_bot().get_me)
+        payload = {"authorized": True, "me": {"id": me.id, "first_name": me.first_name, "username": me.username}}
+    except HTTPException:
+        raise
     except Exception:
-        return {"authorized": False}
+        payload = {"authorized": False}
+    return conditional_json(request, payload)
 
 
 # ==== ДИАЛОГИ и ИСТОРИЯ ====
 
 @app.get("/dialogs")
-async def get_dialogs(limit: int = 100, account: str = ""):
+async def get_dialogs(request: Request, limit: int = 100, account: str = ""):
     client: Client
     if account:
-        client = get_or_create_client(account)
-        await ensure_client_connected(client)
+        client = await get_connected_client(account)
     else:
         await ensure_started()
-        client = bot
+        client = get_bot()
     # Проверим авторизацию, чтобы не провоцировать интерактивный вход
     try:
-        await client.get_me()
+        await coalesced(account, "get_me", (), client.get_me)
+    except HTTPException:
+        raise
     except Exception:
         raise HTTPException(status_code=401, detail="Not authorized")
     dialogs: List[Dict[str, Any]] = []
-    async for d in client.get_dialogs(limit=limit):
+    for d in await coalesced(account, "get_dialogs", (limit,), lambda: collect_dialogs(client, limit)):
         chat = d.chat
         # filter: only private chats
         try:
@@ -453,20 +909,22 @@ async def get_dialogs(limit: int = 100, account: str = ""):
                 "last_message_text": last_text,
             }
         )
-    return {"dialogs": dialogs}
+    # Список диалогов приходит из Telegram, поэтому ETag считается по содержимому
+    return conditional_json(request, {"dialogs": dialogs})
 
 
 @app.get("/messages")
-async def get_messages(chat_id: int, limit: int = 50, before_id: Optional[int] = None, account: str = ""):
+async def get_messages(chat_id: int, limit: int = 50, before_id: Optional[int] = None, account: str = "", include_media: bool = False):
     client: Client
     if account:
-        client = get_or_create_client(account)
-        await ensure_client_connected(client)
+        client = await get_connected_client(account)
     else:
         await ensure_started()
-        client = bot
+        client = get_bot()
     try:
-        await client.get_me()
+        await coalesced(account, "get_me", (), client.get_me)
+    except HTTPException:
+        raise
     except Exception:
         raise HTTPException(status_code=401, detail="Not authorized")
     history = []
@@ -478,20 +936,24 @@ async def get_messages(chat_id: int, limit: int = 50, before_id: Optional[int] =
             kwargs["max_id"] = int(before_id) - 1
         except Exception:
             pass
-    async for m in client.get_chat_history(chat_id, **kwargs):
-        text_content = (m.text or m.caption or "").strip()
-        if not text_content:
-            # пропускаем пустые сообщения (медиа/сервисные) по запросу пользователя
-            continue
-        history.append(
-            {
-                "id": m.id,
-                "text": text_content,
-                "date": int(m.date.timestamp()) if m.date else None,
-                "from_user_id": m.from_user.id if m.from_user else None,
-                "outgoing": m.outgoing,
-            }
-        )
+    async with admit(account):
+        async for m in client.get_chat_history(chat_id, **kwargs):
+            text_content = (m.text or m.caption or "").strip()
+            media = describe_media(m)
+            if not text_content and not (include_media and media):
+                # пропускаем пустые сообщения (медиа/сервисные) по запросу пользователя;
+                # медиа без подписи отдаём только при include_media=true
+                continue
+            history.append(
+                {
+                    "id": m.id,
+                    "text": text_content,
+                    "date": int(m.date.timestamp()) if m.date else None,
+                    "from_user_id": m.from_user.id if m.from_user else None,
+                    "outgoing": m.outgoing,
+                    "media": media,
+                }
+            )
     history.reverse()
     return {"chat_id": chat_id, "messages": history}
 
@@ -500,17 +962,20 @@ async def get_messages(chat_id: int, limit: int = 50, before_id: Optional[int] =
 async def chat_info(chat_id: int, account: str = ""):
     client: Client
     if account:
-        client = get_or_create_client(account)
-        await ensure_client_connected(client)
+        client = await get_connected_client(account)
     else:
         await ensure_started()
-        client = bot
+        client = get_bot()
     try:
-        await client.get_me()
+        await coalesced(account, "get_me", (), client.get_me)
+    except HTTPException:
+        raise
     except Exception:
         raise HTTPException(status_code=401, detail="Not authorized")
     try:
-        ch = await client.get_chat(chat_id)
+        ch = await coalesced(account, "get_chat", (chat_id,), lambda: client.get_chat(chat_id))
+    except HTTPException:
+        raise
     except Exception as e:
         raise HTTPException(status_code=404, detail=str(e))
 
@@ -549,16 +1014,425 @@ async def api_send_message(payload: Dict[str, Any]):
         raise HTTPException(status_code=400, detail="chat_id and text are required")
 
     if account:
-        client = get_or_create_client(account)
-        await ensure_client_connected(client)
+        client = await get_connected_client(account)
     else:
         await ensure_started()
-        client = bot
+        client = get_bot()
+    async with admit(account):
+        try:
+            sent = await client.send_message(chat_id=chat_id, text=text, reply_to_message_id=reply_to_message_id)
+            return {"ok": True, "message_id": sent.id}
+        except Exception as e:
+            raise HTTPException(status_code=400, detail=str(e))
+
+
+# ==== МЕДИА ====
+
+MEDIA_KINDS = ("photo", "video", "animation", "document", "audio", "voice", "video_note", "sticker")
+MEDIA_CHUNK_SIZE = 256 * 1024
+TELEGRAM_CHUNK_SIZE = 1024 * 1024  # размер чанка stream_media в Pyrogram
+
+# Текущие скачивания в кэш: ключ кэша -> скачивание (общее для одновременных запросов)
+media_downloads: Dict[str, "MediaDownload"] = {}
+# Файлы кэша, которые сейчас отдаются клиентам: ключ -> число ссылок (не вытесняются)
+media_in_use: Dict[str, int] = {}
+
+
+def get_media_object(message: Message) -> Optional[Any]:
+    for kind in MEDIA_KINDS:
+        obj = getattr(message, kind, None)
+        if obj is not None:
+            return obj
+    return None
+
+
+def describe_media(message: Message) -> Optional[Dict[str, Any]]:
+    obj = get_media_object(message)
+    if obj is None:
+        return None
+    kind = next((k for k in MEDIA_KINDS if getattr(message, k, None) is obj), "document")
+    return {
+        "type": kind,
+        "mime_type": getattr(obj, "mime_type", None) or ("image/jpeg" if kind == "photo" else None),
+        "file_name": getattr(obj, "file_name", None),
+        "file_size": getattr(obj, "file_size", None),
+        "width": getattr(obj, "width", None),
+        "height": getattr(obj, "height", None),
+        "duration": getattr(obj, "duration", None),
+        "has_thumb": bool(getattr(obj, "thumbs", None)),
+    }
+
+
+def media_cache_key(file_unique_id: str, thumb: bool) -> str:
+    safe = re.sub(r"[^A-Za-z0-9_-]", "_", file_unique_id)
+    return safe + (".thumb" if thumb else "")
+
+
+def scan_media_cache() -> Tuple[List[Tuple[float, int, Path]], int]:
+    # Выполняется в потоке: только чтение каталога, без удалений
+    entries = []
+    total = 0
+    for p in media_cache_dir.iterdir():
+        if not p.is_file() or p.name.endswith(".part"):
+            continue
+        try:
+            st = p.stat()
+        except OSError:
+            continue
+        entries.append((st.st_mtime, st.st_size, p))
+        total += st.st_size
+    entries.sort(key=lambda e: e[0])
+    return entries, total
+
+
+async def evict_media_cache() -> None:
+    # Удаляем самые давно использованные файлы (по mtime), пока кэш не влезет в лимит.
+    # Проверка media_in_use и удаление идут в event loop, как и acquire_media, поэтому не пересекаются.
+    entries, total = await asyncio.to_thread(scan_media_cache)
+    for _, size, p in entries:
+        if total <= media_cache_max_bytes:
+            break
+        if media_in_use.get(p.name):
+            continue
+        try:
+            p.unlink()
+            total -= size
+        except OSError:
+            pass
+
+
+class MediaDownload:
+    # Одно скачивание файла в кэш: пишет в .part, читатели отдают уже записанную часть (см. iter_download_range)
+    def __init__(self, path: Path) -> None:
+        self.path = path
+        self.part_path = path.with_name("{}.{}.part".format(path.name, uuid.uuid4().hex))
+        self.written = 0
+        self.finished = False
+        self.error: Optional[BaseException] = None
+        self.progress = asyncio.Event()
+        self.task: Optional["asyncio.Task[None]"] = None
+
+    def notify(self) -> None:
+        event, self.progress = self.progress, asyncio.Event()
+        event.set()
+
+    async def wait_for(self, position: int) -> None:
+        while self.written <= position and not self.finished:
+            await self.progress.wait()
+        if self.written <= position:
+            raise RuntimeError("Media download failed: {}".format(self.error or "file is shorter than expected"))
+
+    async def run(self, client: Client, file_id: str, fd: int) -> None:
+        try:
+            try:
+                async for chunk in client.stream_media(file_id):
+                    await asyncio.to_thread(write_all, fd, chunk)
+                    self.written += len(chunk)
+                    self.notify()
+            finally:
+                os.close(fd)
+            os.replace(self.part_path, self.path)
+        except BaseException as e:
+            self.error = e
+            try:
+                self.part_path.unlink()
+            except OSError:
+                pass
+            raise
+        finally:
+            self.finished = True
+            self.notify()
+        await evict_media_cache()
+
+
+def write_all(fd: int, data: bytes) -> None:
+    view = memoryview(data)
+    while view:
+        view = view[os.write(fd, view):]
+
+
+def start_media_download(client: Client, account: str, key: str, file_id: str) -> MediaDownload:
+    download = media_downloads.get(key)
+    if download is None:
+        admission = Admission(account, media=True)
+        download = MediaDownload(media_cache_dir / key)
+        # .part создаём сразу, чтобы читатели могли открыть его ещё до первого чанка
+        try:
+            fd = os.open(download.part_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o644)
+        except OSError:
+            admission.release()
+            raise
+        download.task = asyncio.create_task(download.run(client, file_id, fd))
+        media_downloads[key] = download
+
+        def _done(t: "asyncio.Task[None]") -> None:
+            media_downloads.pop(key, None)
+            admission.release()
+            if not t.cancelled():
+                t.exception()  # ошибку получают читатели через MediaDownload.error
+
+        download.task.add_done_callback(_done)
+    return download
+
+
+class PartFile:
+    # Дескриптор .part для читателя; close() идемпотентен — его зовут и итератор, и фоновая задача ответа
+    def __init__(self, fd: int) -> None:
+        self.fd: Optional[int] = fd
+
+    def close(self) -> None:
+        fd, self.fd = self.fd, None
+        if fd is not None:
+            os.close(fd)
+
+
+def open_download(download: MediaDownload) -> Optional[PartFile]:
+    # Открываем .part без await между проверкой и open: файл ещё не переименован.
+    # None — скачивание уже завершилось, файл нужно брать из кэша.
+    if download.finished:
+        return None
     try:
-        sent = await client.send_message(chat_id=chat_id, text=text, reply_to_message_id=reply_to_message_id)
-        return {"ok": True, "message_id": sent.id}
-    except Exception as e:
-        raise HTTPException(status_code=400, detail=str(e))
+        return PartFile(os.open(download.part_path, os.O_RDONLY))
+    except OSError:
+        return None
+
+
+async def iter_download_range(download: MediaDownload, part: PartFile, start: int, end: int):
+    # Хвост общего скачивания: ждём, пока нужные байты будут записаны, и читаем их через pread
+    try:
+        position = start
+        while position <= end:
+            await download.wait_for(position)
+            if part.fd is None:
+                break
+            length = min(MEDIA_CHUNK_SIZE, end - position + 1, download.written - position)
+            chunk = await asyncio.to_thread(os.pread, part.fd, length, position)
+            if not chunk:
+                break
+            position += len(chunk)
+            yield chunk
+    finally:
+        part.close()
+
+
+def acquire_media(key: str) -> Optional[Tuple[Path, os.stat_result]]:
+    # Берём ссылку до проверки существования: пока она есть, файл не будет вытеснен
+    path = media_cache_dir / key
+    media_in_use[key] = media_in_use.get(key, 0) + 1
+    try:
+        os.utime(path)
+        return path, path.stat()
+    except OSError:
+        release_media(key)
+        return None
+
+
+def release_media(key: str) -> None:
+    count = media_in_use.get(key, 0) - 1
+    if count > 0:
+        media_in_use[key] = count
+    else:
+        media_in_use.pop(key, None)
+
+
+def parse_range(header: str, size: int) -> Optional[tuple]:
+    # Поддерживаем один диапазон bytes=start-end / start- / -suffix; иначе None
+    m = re.fullmatch(r"\s*bytes=(\d*)-(\d*)\s*", header)
+    if not m or (not m.group(1) and not m.group(2)):
+        return None
+    if m.group(1):
+        start = int(m.group(1))
+        end = int(m.group(2)) if m.group(2) else size - 1
+    else:
+        start = max(size - int(m.group(2)), 0)
+        end = size - 1
+    return start, min(end, size - 1)
+
+
+async def iter_file_range(path: Path, start: int, end: int):
+    with open(path, "rb") as f:
+        f.seek(start)
+        remaining = end - start + 1
+        while remaining > 0:
+            chunk = await asyncio.to_thread(f.read, min(MEDIA_CHUNK_SIZE, remaining))
+            if not chunk:
+                break
+            remaining -= len(chunk)
+            yield chunk
+
+
+async def iter_telegram_range(client: Client, file_id: str, start: int, end: int):
+    # stream_media отдаёт файл чанками по 1 МиБ: запрашиваем только нужные и обрезаем края
+    first = start // TELEGRAM_CHUNK_SIZE
+    last = end // TELEGRAM_CHUNK_SIZE
+    skip = start - first * TELEGRAM_CHUNK_SIZE
+    remaining = end - start + 1
+    async for chunk in client.stream_media(file_id, offset=first, limit=last - first + 1):
+        if skip:
+            chunk = chunk[skip:]
+            skip = 0
+        chunk = chunk[:remaining]
+        remaining -= len(chunk)
+        yield chunk
+        if remaining <= 0:
+            break
+
+
+def range_response(
+    request: Request,
+    size: int,
+    media_type: str,
+    headers: Dict[str, str],
+    iter_range: Callable[[int, int], Any],
+    background: Optional[BackgroundTask] = None,
+) -> Optional[Response]:
+    # 206/416 для одиночного Range; None — если нужно отдать файл целиком
+    range_header = request.headers.get("range")
+    if not range_header or "," in range_header:
+        return None
+    rng = parse_range(range_header, size)
+    if rng is None or rng[0] >= size or rng[0] > rng[1]:
+        return Response(status_code=416, headers={"Content-Range": "bytes */{}".format(size)}, background=background)
+    start, end = rng
+    headers = dict(headers)
+    headers["Content-Range"] = "bytes {}-{}/{}".format(start, end, size)
+    headers["Content-Length"] = str(end - start + 1)
+    return StreamingResponse(iter_range(start, end), status_code=206, media_type=media_type, headers=headers, background=background)
+
+
+def media_file_response(
+    request: Request, key: str, path: Path, stat_result: os.stat_result, media_type: str, etag: str
+) -> Response:
+    # Ссылка на файл (acquire_media) освобождается фоновой задачей после отправки ответа
+    release = BackgroundTask(release_media, key)
+    headers = {"Accept-Ranges": "bytes", "ETag": etag, "Cache-Control": "private, max-age=86400"}
+    if etag_matches(request, etag):
+        return Response(status_code=304, headers=headers, background=release)
+    response = range_response(
+        request, stat_result.st_size, media_type, headers, lambda s, e: iter_file_range(path, s, e), release
+    )
+    if response is not None:
+        return response
+    # Полный ответ: FileResponse отдаёт файл с диска чанками (или через pathsend, если сервер умеет)
+    return FileResponse(str(path), media_type=media_type, headers=headers, stat_result=stat_result, background=release)
+
+
+def download_media_response(
+    request: Request, download: MediaDownload, part: PartFile, size: int, media_type: str, etag: str
+) -> Response:
+    # Отдаём файл по мере общего скачивания в кэш (в т.ч. Range) — без второго запроса к Telegram
+    headers = {"Accept-Ranges": "bytes", "ETag": etag, "Cache-Control": "private, max-age=86400"}
+    close = BackgroundTask(part.close)  # если поток так и не начался (416, обрыв до первого чанка)
+    response = range_response(
+        request, size, media_type, headers, lambda s, e: iter_download_range(download, part, s, e), close
+    )
+    if response is not None:
+        return response
+    headers["Content-Length"] = str(size)
+    return StreamingResponse(
+        iter_download_range(download, part, 0, size - 1), media_type=media_type, headers=headers, background=close
+    )
+
+
+def telegram_media_response(
+    request: Request, client: Client, account: str, file_id: str, size: int, media_type: str, etag: str
+) -> Response:
+    # Поток прямо из Telegram, без ожидания полного скачивания; слот лимита скачиваний держится до конца отправки
+    headers = {"ETag": etag, "Cache-Control": "private, max-age=86400"}
+    if etag_matches(request, etag):
+        return Response(status_code=304, headers=headers)
+    admission = Admission(account)
+    release = BackgroundTask(admission.release)
+    if size <= 0:
+        return StreamingResponse(
+            iter_admitted(admission, client.stream_media(file_id)), media_type=media_type, headers=headers, background=release
+        )
+    headers["Accept-Ranges"] = "bytes"
+    response = range_response(
+        request,
+        size,
+        media_type,
+        headers,
+        lambda s, e: iter_admitted(admission, iter_telegram_range(client, file_id, s, e)),
+        release,
+    )
+    if response is not None:
+        return response
+    headers["Content-Length"] = str(size)
+    return StreamingResponse(
+        iter_admitted(admission, iter_telegram_range(client, file_id, 0, size - 1)),
+        media_type=media_type,
+        headers=headers,
+        background=release,
+    )
+
+
+@app.get("/media")
+async def get_media(request: Request, chat_id: int, message_id: int, thumb: bool = False, account: str = ""):
+    client: Client
+    if account:
+        client = await get_connected_client(account)
+    else:
+        await ensure_started()
+        client = get_bot()
+    try:
+        await coalesced(account, "get_me", (), client.get_me)
+    except HTTPException:
+        raise
+    except Exception:
+        raise HTTPException(status_code=401, detail="Not authorized")
+    async with admit(account):
+        try:
+            m = await client.get_messages(chat_id, message_id)
+        except Exception as e:
+            raise HTTPException(status_code=404, detail=str(e))
+    obj = get_media_object(m) if m is not None and not getattr(m, "empty", False) else None
+    if obj is None:
+        raise HTTPException(status_code=404, detail="Message has no media")
+
+    media_type = getattr(obj, "mime_type", None) or ("image/jpeg" if m.photo is not None else "application/octet-stream")
+    target = obj
+    if thumb:
+        thumbs = getattr(obj, "thumbs", None) or []
+        if not thumbs:
+            raise HTTPException(status_code=404, detail="Media has no thumbnail")
+        target = thumbs[-1]
+        media_type = "image/jpeg"
+
+    file_id = getattr(target, "file_id", None)
+    file_unique_id = getattr(target, "file_unique_id", None)
+    if not file_id or not file_unique_id:
+        raise HTTPException(status_code=404, detail="Media is not downloadable")
+    key = media_cache_key(file_unique_id, thumb)
+    etag = '"{}"'.format(key)
+    file_size = getattr(target, "file_size", None) or 0
+
+    if file_size > media_cache_max_bytes:
+        # Файл больше всего кэша — проксируем поток из Telegram без сохранения на диск
+        return telegram_media_response(request, client, account, file_id, file_size, media_type, etag)
+
+    if etag_matches(request, etag):
+        return Response(status_code=304, headers={"ETag": etag, "Cache-Control": "private, max-age=86400"})
+
+    for _ in range(3):
+        cached = acquire_media(key)
+        if cached is not None:
+            return media_file_response(request, key, cached[0], cached[1], media_type, etag)
+        download = start_media_download(client, account, key, file_id)
+        if file_size > 0:
+            part = open_download(download)
+            if part is not None:
+                return download_media_response(request, download, part, file_size, media_type, etag)
+            if download.error is not None:
+                raise HTTPException(status_code=502, detail=str(download.error))
+        else:
+            # Размер неизвестен (нельзя выставить Content-Length/Range) — ждём окончания скачивания
+            try:
+                # shield: отмена одного запроса не должна обрывать общее скачивание
+                await asyncio.shield(download.task)
+            except Exception as e:
+                raise HTTPException(status_code=502, detail=str(e))
+    raise HTTPException(status_code=503, detail="Media cache is busy", headers={"Retry-After": "1"})
 
 
 # ==== REAL-TIME WS ====
@@ -585,13 +1459,17 @@ async def websocket_endpoint(ws: WebSocket):
 # ==== ОЧЕРЕДЬ ДИАЛОГОВ ====
 
 @app.get("/queue")
-async def get_queue(account: str = ""):
+async def get_queue(request: Request, account: str = ""):
     # Топап очереди непрочитанными диалогами (добавляем недостающие даже если очередь не пуста)
     if account:
         try:
-            client = get_or_create_client(account)
-            await ensure_client_connected(client)
-            async for d in client.get_dialogs():
+            client = await get_connected_client(account)
+            dialogs = await coalesced(account, "get_dialogs", (0,), lambda: collect_dialogs(client))
+        except Exception:
+            # в т.ч. 503 от лимита аккаунта: топап пропускаем, очередь отдаём из локального состояния
+            dialogs = []
+        try:
+            for d in dialogs:
                 unread = getattr(d, "unread_messages_count", 0)
                 chat = getattr(d, "chat", None)
                 if not chat:
@@ -602,17 +1480,22 @@ async def get_queue(account: str = ""):
                     type_name = getattr(ctype, "value", None) or (str(ctype).lower() if ctype is not None else "")
                 except Exception:
                     type_name = ""
-                if unread and type_name == "private":
+                if unread and type_name == "private" and not is_read_pending(account, chat.id):
                     async with queue_lock:
                         ensure_in_queue_for_account(account, chat.id)
         except Exception:
             pass
         order = queued_chat_order_by_account.get(account, [])
-        return {"queue": order}
+        return queue_response(request, account, order)
     else:
         try:
             await ensure_started()
-            async for d in bot.get_dialogs():
+            dialogs = await coalesced("", "get_dialogs", (0,), lambda: collect_dialogs(get_bot()))
+        except Exception:
+            # в т.ч. 503 от лимита аккаунта: топап пропускаем, очередь отдаём из локального состояния
+            dialogs = []
+        try:
+            for d in dialogs:
                 unread = getattr(d, "unread_messages_count", 0)
                 chat = getattr(d, "chat", None)
                 if not chat:
@@ -623,62 +1506,251 @@ async def get_queue(account: str = ""):
                     type_name = getattr(ctype, "value", None) or (str(ctype).lower() if ctype is not None else "")
                 except Exception:
                     type_name = ""
-                if unread and type_name == "private":
+                if unread and type_name == "private" and not is_read_pending("", chat.id):
                     ensure_in_queue(chat.id)
         except Exception:
             pass
-        return {"queue": queued_chat_order}
+        return queue_response(request, "", queued_chat_order)
+
+
+def queue_response(request: Request, account: str, order: List[int]) -> Response:
+    # Очередь целиком локальная, поэтому ETag — это её версия
+    etag = '"q{}-{}"'.format(queue_boot_id, queue_version_by_account.get(account, 0))
+    return conditional_json(request, {"queue": order}, etag=etag)
 
 
 # ==== SPA (Frontend) STATIC SERVE ====
 # Serve the entire built frontend from /app with HTML fallback for client-side routing
+# Сжатые варианты: готовые .br/.gz рядом с файлом (если их положили туда при деплое) или сжатые на лету
+# и закэшированные в памяти.
+# Файлы с хешем в имени (assets/index-XXXXXXXX.js) кэшируются клиентом навсегда, index.html — всегда с ревалидацией.
+# Сжатие на лету идёт в потоке (одно на файл и кодировку), кэш в памяти ограничен SPA_MEMORY_CACHE_MAX_BYTES
+# (сверх лимита — без кэширования) и защищён spa_cache_lock, т.к. его меняют потоки.
+COMPRESSIBLE_SUFFIXES = {".js", ".mjs", ".css", ".html", ".svg", ".json", ".txt", ".webmanifest"}
+HASHED_ASSET_RE = re.compile(r"[.-][A-Za-z0-9_-]{8,}\.[A-Za-z0-9]+$")
+IMMUTABLE_CACHE_CONTROL = "public, max-age=31536000, immutable"
+SPA_MEMORY_CACHE_MAX_BYTES = 32 * 1024 * 1024
+spa_memory_cache: Dict[Tuple[str, str], Tuple[float, bytes]] = {}
+spa_memory_cache_bytes = 0
+spa_cache_lock = threading.Lock()
+# Текущие сжатия: (путь, кодировка, mtime) -> задача (общая для одновременных запросов)
+spa_variant_tasks: Dict[Tuple[str, str, float], "asyncio.Future[bytes]"] = {}
+
+
+def accepted_encodings(accept_encoding: str) -> Set[str]:
+    result: Set[str] = set()
+    for part in accept_encoding.split(","):
+        token, _, params = part.strip().partition(";")
+        token = token.strip().lower()
+        q = params.strip()
+        if q.startswith("q="):
+            try:
+                if float(q[2:]) == 0:
+                    continue
+            except ValueError:
+                continue
+        if token:
+            result.add(token)
+    return result
+
+
+def compress_bytes(data: bytes, encoding: str) -> bytes:
+    if encoding == "br":
+        return brotli.compress(data, quality=9)
+    if encoding == "gzip":
+        return gzip.compress(data, compresslevel=9, mtime=0)
+    return data
+
+
+def cached_spa_variant(full_path: str, mtime: float, encoding: str) -> Optional[bytes]:
+    with spa_cache_lock:
+        cached = spa_memory_cache.get((full_path, encoding))
+    if cached is not None and cached[0] == mtime:
+        return cached[1]
+    return None
+
+
+def load_spa_variant(full_path: str, mtime: float, encoding: str) -> bytes:
+    # Вызывается в потоке: чтение и сжатие не блокируют event loop
+    global spa_memory_cache_bytes
+    cached = cached_spa_variant(full_path, mtime, encoding)
+    if cached is not None:
+        return cached
+    with open(full_path, "rb") as f:
+        data = compress_bytes(f.read(), encoding)
+    key = (full_path, encoding)
+    with spa_cache_lock:
+        stale = spa_memory_cache.pop(key, None)
+        if stale is not None:
+            spa_memory_cache_bytes -= len(stale[1])
+        if stale is not None and stale[0] == mtime:
+            data = stale[1]  # параллельно уже сжали тот же вариант
+        if spa_memory_cache_bytes + len(data) <= SPA_MEMORY_CACHE_MAX_BYTES:
+            spa_memory_cache[key] = (mtime, data)
+            spa_memory_cache_bytes += len(data)
+    return data
+
+
+async def get_spa_variant(full_path: str, mtime: float, encoding: str) -> bytes:
+    key = (full_path, encoding, mtime)
+    task = spa_variant_tasks.get(key)
+    if task is None:
+        task = asyncio.ensure_future(asyncio.to_thread(load_spa_variant, full_path, mtime, encoding))
+        spa_variant_tasks[key] = task
+
+        def _done(t: "asyncio.Future[bytes]") -> None:
+            spa_variant_tasks.pop(key, None)
+            if not t.cancelled():
+                t.exception()
+
+        task.add_done_callback(_done)
+    # shield: отмена одного запроса не должна обрывать общее сжатие
+    return await asyncio.shield(task)
+
+
+class PendingSpaVariant:
+    # Вариант, которого ещё нет в памяти: get_response загрузит его в потоке
+    def __init__(self, full_path: str, mtime: float, encoding: str, status_code: int, media_type: str, headers: Dict[str, str]) -> None:
+        self.full_path = full_path
+        self.mtime = mtime
+        self.encoding = encoding
+        self.status_code = status_code
+        self.media_type = media_type
+        self.headers = headers
+
+
+class SpaStaticFiles(StaticFiles):
+    async def get_response(self, path: str, scope) -> Response:
+        response = await super().get_response(path, scope)
+        if isinstance(response, PendingSpaVariant):
+            body = await get_spa_variant(response.full_path, response.mtime, response.encoding)
+            return Response(
+                content=body, status_code=response.status_code, media_type=response.media_type, headers=response.headers
+            )
+        return response
+
+    def file_response(self, full_path, stat_result, scope, status_code: int = 200) -> Any:
+        request_headers = Headers(scope=scope)
+        full_path = str(full_path)
+        name = os.path.basename(full_path)
+        suffix = os.path.splitext(name)[1].lower()
+        rel = os.path.relpath(full_path, str(self.directory)).replace(os.sep, "/")
+        is_index = name == "index.html"
+        immutable = rel.startswith("assets/") and bool(HASHED_ASSET_RE.search(name))
+        headers = {"Cache-Control": IMMUTABLE_CACHE_CONTROL if immutable else "no-cache"}
+        if suffix in COMPRESSIBLE_SUFFIXES:
+            headers["Vary"] = "Accept-Encoding"
+
+        encoding = "identity"
+        sibling: Optional[str] = None
+        if suffix in COMPRESSIBLE_SUFFIXES:
+            accepted = accepted_encodings(request_headers.get("accept-encoding", ""))
+            for enc, ext in (("br", ".br"), ("gzip", ".gz")):
+                if enc not in accepted:
+                    continue
+                candidate = full_path + ext
+                try:
+                    if os.stat(candidate).st_mtime >= stat_result.st_mtime:
+                        encoding, sibling = enc, candidate
+                        break
+                except OSError:
+                    pass
+                if enc == "gzip" or brotli is not None:
+                    encoding = enc
+                    break
+
+        if sibling is None and encoding == "identity" and not is_index:
+            response = FileResponse(full_path, status_code=status_code, stat_result=stat_result, headers=headers)
+            if self.is_not_modified(response.headers, request_headers):
+                return NotModifiedResponse(response.headers)
+            return response
+
+        media_type = mimetypes.guess_type(name)[0] or "application/octet-stream"
+        if encoding != "identity":
+            headers["Content-Encoding"] = encoding
+        if sibling is not None:
+            response = FileResponse(sibling, status_code=status_code, media_type=media_type, headers=headers)
+        else:
+            # index.html и сжатые на лету варианты отдаются из памяти
+            base_etag = hashlib.md5("{}-{}".format(stat_result.st_mtime, stat_result.st_size).encode()).hexdigest()
+            headers["ETag"] = '"{}{}"'.format(base_etag, "" if encoding == "identity" else "-" + encoding)
+            if self.is_not_modified(Headers(headers=headers), request_headers):
+                return NotModifiedResponse(Headers(headers=headers))
+            body = cached_spa_variant(full_path, stat_result.st_mtime, encoding)
+            if body is None:
+                return PendingSpaVariant(full_path, stat_result.st_mtime, encoding, status_code, media_type, headers)
+            response = Response(content=body, status_code=status_code, media_type=media_type, headers=headers)
+        if self.is_not_modified(response.headers, request_headers):
+            return NotModifiedResponse(response.headers)
+        return response
+
+
 try:
     DIST_DIR = (Path(__file__).parent / "frontend" / "dist").resolve()
     if DIST_DIR.exists():
-        app.mount("/app", StaticFiles(directory=str(DIST_DIR), html=True), name="app")
+        app.mount("/app", SpaStaticFiles(directory=str(DIST_DIR), html=True), name="app")
 except Exception:
     pass
 
 
-@app.post("/queue/action")
-async def queue_action(payload: Dict[str, Any]):
-    chat_id = payload.get("chat_id")
-    action = str(payload.get("action", "")).lower()
-    if chat_id is None or action not in {"done", "postpone", "task"}:
-        raise HTTPException(status_code=400, detail="chat_id and valid action are required")
+QUEUE_ACTIONS = {"done", "postpone", "task"}
 
-    account = str(payload.get("account", "")).strip()
+
+async def apply_queue_action(account: str, chat_id: Any, action: str) -> None:
     if account:
         if action == "done":
-            try:
-                client = get_or_create_client(account)
-                await ensure_client_connected(client)
-                await client.read_chat_history(chat_id)
-            except Exception:
-                pass
+            # прочтение уходит в фоновую очередь, чат убираем сразу
+            schedule_mark_read(account, chat_id)
             async with queue_lock:
                 remove_from_queue_for_account(account, chat_id)
         elif action in {"postpone", "task"}:
             async with queue_lock:
                 move_to_queue_end_for_account(account, chat_id)
-
-        order = queued_chat_order_by_account.get(account, [])
-        next_chat_id = order[0] if order else None
-        return {"ok": True, "next_chat_id": next_chat_id, "queue": order}
     else:
         if action == "done":
             # помечаем диалог как прочитанный, чтобы не всплывал снова из-за старых непрочитанных
-            try:
-                await ensure_started()
-                await bot.read_chat_history(chat_id)
-            except Exception:
-                pass
+            schedule_mark_read("", chat_id)
             remove_from_queue(chat_id)
         elif action in {"postpone", "task"}:
             move_to_queue_end(chat_id)
 
-        next_chat_id = queued_chat_order[0] if queued_chat_order else None
-        return {"ok": True, "next_chat_id": next_chat_id, "queue": queued_chat_order}
+
+def queue_state(account: str) -> Dict[str, Any]:
+    order = queued_chat_order_by_account.get(account, []) if account else queued_chat_order
+    next_chat_id = order[0] if order else None
+    return {"ok": True, "next_chat_id": next_chat_id, "queue": order}
+
+
+@app.post("/queue/action")
+async def queue_action(payload: Dict[str, Any]):
+    chat_id = payload.get("chat_id")
+    action = str(payload.get("action", "")).lower()
+    if chat_id is None or action not in QUEUE_ACTIONS:
+        raise HTTPException(status_code=400, detail="chat_id and valid action are required")
+
+    account = str(payload.get("account", "")).strip()
+    await apply_queue_action(account, chat_id, action)
+    return queue_state(account)
+
+
+@app.post("/queue/actions")
+async def queue_actions(payload: Dict[str, Any]):
+    # Пакетный вариант: {"account": "...", "actions": [{"chat_id": 1, "action": "done"}, ...]}
+    items = payload.get("actions")
+    if not isinstance(items, list) or not items:
+        raise HTTPException(status_code=400, detail="actions must be a non-empty list")
+    parsed: List[Tuple[Any, str]] = []
+    for item in items:
+        chat_id = item.get("chat_id") if isinstance(item, dict) else None
+        action = str(item.get("action", "")).lower() if isinstance(item, dict) else ""
+        if chat_id is None or action not in QUEUE_ACTIONS:
+            raise HTTPException(status_code=400, detail="each action needs chat_id and valid action")
+        parsed.append((chat_id, action))
+
+    account = str(payload.get("account", "")).strip()
+    for chat_id, action in parsed:
+        await apply_queue_action(account, chat_id, action)
+    return queue_state(account)
 
 
 # ==== RESOLVE CONTACT BY PHONE/USER_ID/USERNAME ====
@@ -698,7 +1770,11 @@ def _normalize_phone_e164(phone: str) -> str:
 
 
 async def _resolve_user_by_phone_client(client: Client, phone: str) -> Optional[int]:
-    if ImportContacts is None or InputPhoneContact is None:
+    try:
+        # Optional raw imports for resolving phone -> user
+        from pyrogram.raw.functions.contacts import ImportContacts  # type: ignore
+        from pyrogram.raw.types import InputPhoneContact  # type: ignore
+    except Exception:
         return None
     try:
         normalized = _normalize_phone_e164(phone)
@@ -724,11 +1800,10 @@ async def resolve_contact(payload: Dict[str, Any]):
     account = str(payload.get("account", "")).strip()
     client: Client
     if account:
-        client = get_or_create_client(account)
-        await ensure_client_connected(client)
+        client = await get_connected_client(account)
     else:
         await ensure_started()
-        client = bot
+        client = get_bot()
     user_id = payload.get("user_id")
     phone = payload.get("phone")
     username = payload.get("username")
@@ -744,7 +1819,8 @@ async def resolve_contact(payload: Dict[str, Any]):
 
     if phone:
         raw_phone = str(phone).strip()
-        uid = await _resolve_user_by_phone_client(client, raw_phone)
+        async with admit(account):
+            uid = await _resolve_user_by_phone_client(client, raw_phone)
         if uid:
             return {"ok": True, "user_id": uid, "chat_id": uid}
 
@@ -765,7 +1841,8 @@ async def resolve_contact(payload: Dict[str, Any]):
         if uname.startswith("@"):
             uname = uname[1:]
         try:
-            ch = await client.get_chat(uname)
+            async with admit(account):
+                ch = await client.get_chat(uname)
             try:
                 ctype = getattr(ch, "type", None)
                 type_name = getattr(ctype, "value", None) or (str(ctype).lower() if ctype is not None else "")